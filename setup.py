@@ -9,6 +9,7 @@ setup(
     author="Jevgeni Kiski",
     author_email="yozik04@gmail.com",
     description="x708 Automatic Safe Shutdown",
-    install_requires=["RPi.GPIO~=0.7.0", "smbus~=1.1.0"],
+    install_requires=["smbus2>=0.4", "async-timeout>=3.0"],
+    extras_require={"uvloop": ["uvloop"]},
     scripts=["bin/x708daemon"],
 )
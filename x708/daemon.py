@@ -4,25 +4,41 @@
 import asyncio
 import logging
 import signal
-import struct
 import subprocess
 import sys
+import time
 import typing
+from abc import ABC, abstractmethod
 from contextlib import AbstractContextManager, ExitStack, suppress
-from datetime import datetime
 from enum import Enum
 
-import RPi.GPIO as GPIO
-import smbus
+import async_timeout
+import gpiod
+from smbus2 import SMBus, i2c_msg
+
+GPIO_CHIP = "gpiochip0"
+GPIO_CONSUMER = "x708power"
 
 POWER_LOST_GPIO_IN = 6
 BOOT_GPIO_OUT = 12
 X708_POWER_OFF_GPIO_OUT = 13
 SHUTDOWN_BUTTON_PRESS_GPIO_IN = 5
 
+# Edge debounce in milliseconds
+POWER_LOST_BOUNCE_TIME = 100
+BUTTON_BOUNCE_TIME = 50
+
 MIN_VOLTAGE = 3.2
 MIN_CAPACITY = 15
 
+# Battery poll intervals in seconds, polling only happens while on battery
+POLL_INTERVAL_ON_BATTERY = 5
+POLL_INTERVAL_NEAR_LOW_BATTERY = 1
+NEAR_LOW_CAPACITY_MARGIN = 5
+
+_VOLT_SCALE = 1.25 / 16000.0  # VCELL LSB is 1.25mV, upper 12 bits used
+_CAP_SCALE = 1.0 / 256.0  # SOC high byte is %, low byte is 1/256%
+
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 logger = logging.getLogger("x708power")
@@ -33,122 +49,205 @@ class PressAction(Enum):
     LONG_PRESS = 2
 
 
-class PowerLostMonitor(AbstractContextManager):
-    def __init__(self, gpio_pin: int, on_state_change: typing.Callable[[bool], None]):
+class GPIOEdgeMonitor(AbstractContextManager, ABC):
+    """Watches both edges of an input line via the event loop's selector.
+
+    Edge callbacks are always invoked on the event loop thread, so they may
+    touch loop state and controller attributes directly.
+    """
+
+    def __init__(self, chip: gpiod.Chip, gpio_pin: int, bounce_time: int):
+        self._loop = asyncio.get_event_loop()
+        self._chip = chip
         self._gpio_pin = gpio_pin
-        self._on_state_change = on_state_change
+        self._bounce_time = bounce_time / 1000
+        self._last_edge_time = None
+        self._last_level = None
+        self._settle_handle = None
+        self._line = None
 
     def __enter__(self):
-        GPIO.setup(self._gpio_pin, GPIO.IN)
-        GPIO.add_event_detect(self._gpio_pin, GPIO.BOTH, callback=self._read_power_lost)
-
-        self._read_power_lost(self._gpio_pin)
+        self._line = self._chip.get_line(self._gpio_pin)
+        self._line.request(consumer=GPIO_CONSUMER, type=gpiod.LINE_REQ_EV_BOTH_EDGES)
+        self._loop.add_reader(self._line.event_get_fd(), self._on_edge)
         return self
 
     def __exit__(self, *exc):
-        GPIO.remove_event_detect(self._gpio_pin)
+        if self._settle_handle is not None:
+            self._settle_handle.cancel()
+        self._loop.remove_reader(self._line.event_get_fd())
+        self._line.release()
         return False
 
-    def _read_power_lost(self, channel: int):
-        is_power_lost = GPIO.input(channel)
+    def _on_edge(self):
+        event = self._line.event_read()
+        edge_time = event.sec + event.nsec / 1e9
+        if (
+            self._last_edge_time is not None
+            and edge_time - self._last_edge_time < self._bounce_time
+        ):
+            # Re-read once the line has settled, the dropped edge may have
+            # been the last one.
+            if self._settle_handle is None:
+                self._settle_handle = self._loop.call_later(
+                    self._bounce_time, self._on_settled
+                )
+            return
+
+        self._last_edge_time = edge_time
+        self._read_level()
+
+    def _on_settled(self):
+        self._settle_handle = None
+        self._read_level()
+
+    def _read_level(self):
+        # Use the current level rather than the edge type, and only report
+        # changes so a settle re-read does not repeat the last level.
+        is_high = bool(self._line.get_value())
+        if is_high == self._last_level:
+            return
+
+        self._last_level = is_high
+        self._on_level_change(is_high)
+
+    @abstractmethod
+    def _on_level_change(self, is_high: bool):
+        pass
+
+
+class PowerLostMonitor(GPIOEdgeMonitor):
+    def __init__(
+        self,
+        chip: gpiod.Chip,
+        gpio_pin: int,
+        on_state_change: typing.Callable[[bool], None],
+    ):
+        super().__init__(chip, gpio_pin, POWER_LOST_BOUNCE_TIME)
+        self._on_state_change = on_state_change
 
-        logger.warning("Power " + ("lost" if is_power_lost else "OK"))
-        self._on_state_change(is_power_lost)
+    def __enter__(self):
+        super().__enter__()
 
+        self._read_level()
+        return self
 
-class PowerButtonPressMonitor(AbstractContextManager):
-    def __init__(self, gpio_pin: int, on_action: typing.Callable[[PressAction], None]):
-        self._loop = asyncio.get_event_loop()
-        self._on_action = on_action
-        self._release_future = None
+    def _on_level_change(self, is_high: bool):
+        # Only genuine transitions get here, see GPIOEdgeMonitor._read_level
+        logger.warning("Power %s", "lost" if is_high else "OK")
+        self._on_state_change(is_high)
 
-        self._gpio_pin = gpio_pin
 
-    def __enter__(self):
-        GPIO.setup(self._gpio_pin, GPIO.IN)
-        GPIO.add_event_detect(
-            self._gpio_pin, GPIO.BOTH, callback=self._on_button_toggle
-        )
-        return self
+class PowerButtonPressMonitor(GPIOEdgeMonitor):
+    def __init__(
+        self,
+        chip: gpiod.Chip,
+        gpio_pin: int,
+        on_action: typing.Callable[[PressAction], None],
+    ):
+        super().__init__(chip, gpio_pin, BUTTON_BOUNCE_TIME)
+        self._on_action = on_action
+        self._release_event = asyncio.Event()
 
-    def __exit__(self, *exc):
-        GPIO.remove_event_detect(self._gpio_pin)
-        return False
+    def _on_level_change(self, is_high: bool):
+        self._on_button_toggle(is_high)
 
-    def _on_button_toggle(self, channel):
-        if GPIO.input(channel):
-            self._loop.call_soon_threadsafe(
-                lambda: self._loop.create_task(self._on_press())
-            )
+    def _on_button_toggle(self, is_pressed: bool):
+        if is_pressed:
+            self._loop.create_task(self._on_press())
         else:
-            self._loop.call_soon_threadsafe(
-                lambda: self._loop.create_task(self._on_release())
-            )
+            self._loop.create_task(self._on_release())
 
     async def _on_press(self):
-        self._release_future = asyncio.Future()
+        self._release_event.clear()
         try:
-            await asyncio.wait_for(self._release_future, 2)
+            async with async_timeout.timeout(2):
+                await self._release_event.wait()
             self._on_action(PressAction.SHORT_PRESS)
 
         except asyncio.TimeoutError:
             self._on_action(PressAction.LONG_PRESS)
 
     async def _on_release(self):
-        if self._release_future and not self._release_future.done():
-            self._release_future.set_result(False)
+        self._release_event.set()
 
 
 class BatteryLevelMonitor:
-    def __init__(self, smbus: smbus.SMBus, device_address: int):
+    def __init__(self, smbus: SMBus, device_address: int):
         self._bus = smbus
         self._device_address = device_address
         self.capacity = None
         self.voltage = None
 
-    def read_voltage(self) -> None:
-        read = self._bus.read_word_data(self._device_address, 2)
-        swapped = struct.unpack("<H", struct.pack(">H", read))[0]
-        self.voltage = swapped * 1.25 / 1000 / 16
-
-    def read_capacity(self) -> None:
-        read = self._bus.read_word_data(self._device_address, 4)
-        swapped = struct.unpack("<H", struct.pack(">H", read))[0]
-        self.capacity = swapped / 256
-
     def read_metrics(self) -> None:
-        self.read_voltage()
-        self.read_capacity()
+        # VCELL (0x02) and SOC (0x04) are adjacent big-endian words, so both
+        # are fetched with one combined write-register/read transaction.
+        write = i2c_msg.write(self._device_address, [2])
+        read = i2c_msg.read(self._device_address, 4)
+        self._bus.i2c_rdwr(write, read)
+        raw = list(read)
+        voltage = (raw[0] << 8) | raw[1]
+        capacity = (raw[2] << 8) | raw[3]
+        self.voltage = voltage * _VOLT_SCALE
+        self.capacity = capacity * _CAP_SCALE
 
 
 class GPIOContextManager(AbstractContextManager):
+    def __init__(self):
+        self.chip = None
+        self.power_off_line = None
+        self._boot_line = None
+
     def __enter__(self):
-        GPIO.setmode(GPIO.BCM)
+        self.chip = gpiod.Chip(GPIO_CHIP)
 
-        GPIO.setup(BOOT_GPIO_OUT, GPIO.OUT)
-        GPIO.output(BOOT_GPIO_OUT, 1)
+        self._boot_line = self.chip.get_line(BOOT_GPIO_OUT)
+        self._boot_line.request(
+            consumer=GPIO_CONSUMER, type=gpiod.LINE_REQ_DIR_OUT, default_vals=[1]
+        )
+
+        self.power_off_line = self.chip.get_line(X708_POWER_OFF_GPIO_OUT)
+        self.power_off_line.request(
+            consumer=GPIO_CONSUMER, type=gpiod.LINE_REQ_DIR_OUT, default_vals=[0]
+        )
         return self
 
     def __exit__(self, *exc):
-        GPIO.cleanup()
+        self.power_off_line.release()
+        self._boot_line.release()
+        self.chip.close()
         return False
 
 
 class PowerController:
-    def __init__(self, battery: BatteryLevelMonitor):
+    def __init__(self, battery: BatteryLevelMonitor, power_off_line: gpiod.Line):
         self.is_power_lost = False
-        self.in_power_mode_since = datetime.now()
+        self._power_lost_at = time.monotonic()
         self.battery = battery
+        self._power_off_line = power_off_line
         self._previous_battery_capacity = -1
+        self._battery_task = None
 
-        self._terminate_event = asyncio.Future()
+        self._loop = asyncio.get_event_loop()
+        self._terminate_event = self._loop.create_future()
 
-        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
-        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self._loop.add_signal_handler(signal.SIGINT, self.stop)
+        self._loop.add_signal_handler(signal.SIGTERM, self.stop)
 
     def on_power_loss_change(self, is_lost: bool) -> None:
         self.is_power_lost = is_lost
-        self.in_power_mode_since = datetime.now()
+        self._power_lost_at = time.monotonic()
+
+        if is_lost:
+            if self._battery_task is None:
+                self._battery_task = self._loop.create_task(self._monitor_battery())
+                self._battery_task.add_done_callback(self._on_battery_task_done)
+
+        elif self._battery_task is not None:
+            # Forget the task right away, it may still be unwinding when power
+            # is lost again and a fresh one has to be started.
+            self._battery_task.cancel()
+            self._battery_task = None
 
     def on_power_button_press(self, action: PressAction):
         if not self._terminate_event.done():
@@ -165,89 +264,140 @@ class PowerController:
         low_battery = False
 
         if self.battery.capacity < MIN_CAPACITY:
-            logger.warning("Battery capacity is under %d%%" % MIN_CAPACITY)
+            logger.warning("Battery capacity is under %d%%", MIN_CAPACITY)
             low_battery = True
 
         if self.battery.voltage < MIN_VOLTAGE:
-            logger.warning("Battery voltage is under %.1fV" % MIN_VOLTAGE)
+            logger.warning("Battery voltage is under %.1fV", MIN_VOLTAGE)
             low_battery = True
 
         return low_battery
 
+    @property
+    def poll_interval(self) -> int:
+        if self.battery.capacity < MIN_CAPACITY + NEAR_LOW_CAPACITY_MARGIN:
+            return POLL_INTERVAL_NEAR_LOW_BATTERY
+
+        return POLL_INTERVAL_ON_BATTERY
+
     def log_status(self):
         if abs(self.battery.capacity - self._previous_battery_capacity) >= 1:
             self._previous_battery_capacity = self.battery.capacity
             logger.info(
-                f"Battery: %d%% %.1fV" % (self.battery.capacity, self.battery.voltage)
+                "Battery: %d%% %.1fV", self.battery.capacity, self.battery.voltage
             )
 
     def log_power_lost_duration(self):
-        seconds = int((datetime.now() - self.in_power_mode_since).total_seconds())
+        seconds = int(time.monotonic() - self._power_lost_at)
         days, rem = divmod(seconds, 86400)
         hours, rem = divmod(rem, 3600)
         minutes, seconds = divmod(rem, 60)
 
-        locals_ = locals()
         magnitudes_str = (
-            "{n} {magnitude}".format(n=int(locals_[magnitude]), magnitude=magnitude)
-            for magnitude in ("days", "hours", "minutes", "seconds")
-            if locals_[magnitude]
+            "{n} {magnitude}".format(n=n, magnitude=magnitude)
+            for n, magnitude in (
+                (days, "days"),
+                (hours, "hours"),
+                (minutes, "minutes"),
+                (seconds, "seconds"),
+            )
+            if n
         )
         logger.info(
-            "Shutdown initiated after " + (", ".join(magnitudes_str)) + " on battery"
+            "Shutdown initiated after %s on battery", ", ".join(magnitudes_str)
         )
 
     async def loop(self):
-        while not self._terminate_event.done():
+        # Battery is only polled while on battery, see on_power_loss_change
+        self.battery.read_metrics()
+        self.log_status()
+
+        try:
+            await self._terminate_event
+        finally:
+            if self._battery_task is not None:
+                self._battery_task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await self._battery_task
+
+    async def _monitor_battery(self):
+        while True:
             self.battery.read_metrics()
             self.log_status()
-            if self.is_power_lost and self.is_low_battery:
+            if self.is_low_battery:
                 logger.info("Initiating shutdown")
                 self.log_power_lost_duration()
 
                 await self.initiate_shutdown()
 
-            with suppress(asyncio.TimeoutError):
-                return await asyncio.wait_for(
-                    asyncio.shield(self._terminate_event), timeout=5
-                )  # Will return when shutdown_event
+            await asyncio.sleep(self.poll_interval)
+
+    def _on_battery_task_done(self, task: asyncio.Task):
+        # Propagate unexpected failures so the daemon exits instead of
+        # silently losing battery supervision.
+        if task is self._battery_task:
+            self._battery_task = None
+
+        if task.cancelled():
+            return
+
+        exc = task.exception()
+        if exc is not None and not self._terminate_event.done():
+            self._terminate_event.set_exception(exc)
 
-    @staticmethod
-    async def initiate_shutdown():
+    async def initiate_shutdown(self):
         # Programmatically holding power button to initiate shut down
-        GPIO.setup(X708_POWER_OFF_GPIO_OUT, GPIO.OUT)
-        GPIO.output(X708_POWER_OFF_GPIO_OUT, 1)
-        await asyncio.sleep(3)
-        GPIO.output(X708_POWER_OFF_GPIO_OUT, 0)
+        self._power_off_line.set_value(1)
+        try:
+            await asyncio.sleep(3)
+        finally:
+            self._power_off_line.set_value(0)
 
     def shutdown(self, reason: str):
-        logger.warning(f"Shutting down ({reason})")
+        logger.warning("Shutting down (%s)", reason)
         subprocess.call(["shutdown", "now"])
         self.stop()
 
     def reboot(self, reason: str):
-        logger.info(f"Rebooting ({reason})")
+        logger.info("Rebooting (%s)", reason)
         subprocess.call(["reboot"])
         self.stop()
 
     def stop(self):
+        if self._terminate_event.done():
+            return
+
         logger.info("Terminating")
         self._terminate_event.set_result(True)
 
 
 def run():
+    try:
+        import uvloop
+
+        # Edges are delivered through add_reader on the loop thread. Any future
+        # call_soon_threadsafe path needs auditing before running on
+        # free-threaded CPython, where its thread safety is not guaranteed.
+        uvloop.install()
+    except ImportError:
+        pass
+
     with ExitStack() as stack:
-        bus = smbus.SMBus(1)  # 0 = /dev/i2c-0 (port I2C0), 1 = /dev/i2c-1 (port I2C1)
+        bus = SMBus(1)  # 0 = /dev/i2c-0 (port I2C0), 1 = /dev/i2c-1 (port I2C1)
         battery_monitor = BatteryLevelMonitor(bus, device_address=0x36)
 
-        controller = PowerController(battery_monitor)
-        stack.enter_context(GPIOContextManager())
+        gpio = stack.enter_context(GPIOContextManager())
+        controller = PowerController(battery_monitor, gpio.power_off_line)
         stack.enter_context(
-            PowerLostMonitor(POWER_LOST_GPIO_IN, controller.on_power_loss_change)
+            PowerLostMonitor(
+                gpio.chip, POWER_LOST_GPIO_IN, controller.on_power_loss_change
+            )
         )
         stack.enter_context(
             PowerButtonPressMonitor(
-                SHUTDOWN_BUTTON_PRESS_GPIO_IN, controller.on_power_button_press
+                gpio.chip,
+                SHUTDOWN_BUTTON_PRESS_GPIO_IN,
+                controller.on_power_button_press,
             )
         )
 